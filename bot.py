@@ -14,65 +14,329 @@ Features
 - /reset — wipe current tournament
 - /help — help
 
-Persistence: JSON file per chat stored in ./data.json
+Persistence: SQLite database in ./data/data.db; chats are cached in memory
+and written back in the background after changes
 
-Requires: python-telegram-bot>=20.0
+Requires: python-telegram-bot>=20.0, aiosqlite (orjson optional, for faster storage)
 
 Run:
   export BOT_TOKEN=123:ABC
-  pip install python-telegram-bot==20.7
+  pip install -r requirements.txt
   python bot.py
+
+Set WEBHOOK_URL (public https base URL, optionally WEBHOOK_SECRET and PORT)
+to receive updates via webhook instead of long polling.
 """
 
 import os
 import json
+import logging
 import math
 import csv
 import io
 import random
-from datetime import datetime
-from typing import Dict, List, Tuple, Any
-
+import re
+import secrets
+import asyncio
+import functools
+import time
+from typing import Dict, List, Tuple, Any, Optional
+
+try:
+    import orjson
+except ImportError:  # stdlib json is slower but keeps the bot runnable
+    orjson = None
+
+import aiosqlite
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import Application, CommandHandler, ContextTypes
 
-# Allow custom storage path for Railway/containers (mount a Volume at /data)
+logger = logging.getLogger(__name__)
+
+# Allow custom storage path for Railway/containers (mount a Volume at /data).
+# JSON storage of older versions; imported into DB_FILE on startup if present
 DATA_FILE = os.getenv("DATA_FILE", "./data/data.json")
+DATA_DIR = os.getenv("DATA_DIR", os.path.dirname(DATA_FILE) or ".")
+DB_FILE = os.getenv("DB_FILE", os.path.splitext(DATA_FILE)[0] + ".db")
+# Indent stored JSON (bracket blobs) for debugging
+PRETTY_JSON = bool(os.getenv("PRETTY_JSON"))
 
 # -----------------------------
 # Storage helpers
 # -----------------------------
 
-def load_db() -> Dict[str, Any]:
-    if not os.path.exists(DATA_FILE):
-        return {}
+_SCHEMA = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    name TEXT,
+    created_at REAL  -- unix time; ISO text in rows imported from JSON
+);
+CREATE TABLE IF NOT EXISTS teams (
+    chat_id INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    name_lc TEXT NOT NULL,
+    PRIMARY KEY (chat_id, idx)
+);
+CREATE TABLE IF NOT EXISTS brackets (
+    chat_id INTEGER PRIMARY KEY,
+    json BLOB NOT NULL
+);
+"""
+
+
+def _loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if PRETTY_JSON else 0)
+        return orjson.dumps(obj, option=option)
+    if PRETTY_JSON:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _new_chat() -> Dict[str, Any]:
+    return {
+        "name": None,
+        "teams": [],
+        "_teams_lc": set(),  # casefolded team names (teams.name_lc)
+        "bracket": None,  # list of rounds; each round is list of pair tuples
+        "created_at": time.time(),
+        "_stored": False,  # whether the chats row exists yet
+    }
+
+
+# save_chat() changes that rewrite a chat completely
+_ALL_CHANGES = {"name": True, "teams": True, "bracket": True}
+
+# Bracket fields derived from "rounds": kept in memory only, rebuilt on demand
+_TRANSIENT_BRACKET_KEYS = ("rendered_full", "rendered_r1", "csv", "chunks")
+
+
+async def open_db() -> aiosqlite.Connection:
+    os.makedirs(os.path.dirname(DB_FILE) or ".", exist_ok=True)
+    conn = await aiosqlite.connect(DB_FILE)
+    await conn.executescript(_SCHEMA)
+    return conn
+
+
+async def load_chat_ro(conn: aiosqlite.Connection, chat_id: int) -> Optional[Dict[str, Any]]:
+    # Unlike load_chat(), returns None instead of creating an empty chat
+    chat = _CHATS.get(chat_id)
+    if chat is not None:
+        return chat
+    async with conn.execute(
+        "SELECT name, created_at FROM chats WHERE chat_id = ?", (chat_id,)
+    ) as cur:
+        row = await cur.fetchone()
+    if row is None:
+        return None
+    chat = {"name": row[0], "created_at": row[1], "_stored": True}
+    async with conn.execute(
+        "SELECT name, name_lc FROM teams WHERE chat_id = ? ORDER BY idx", (chat_id,)
+    ) as cur:
+        teams = await cur.fetchall()
+    chat["teams"] = [name for name, _ in teams]
+    chat["_teams_lc"] = {name_lc for _, name_lc in teams}
+    async with conn.execute(
+        "SELECT json FROM brackets WHERE chat_id = ?", (chat_id,)
+    ) as cur:
+        row = await cur.fetchone()
+    chat["bracket"] = _loads(row[0]) if row else None
+    # Another handler may have loaded the same chat while we were waiting
+    return _CHATS.setdefault(chat_id, chat)
+
+
+async def load_chat(conn: aiosqlite.Connection, chat_id: int) -> Dict[str, Any]:
+    chat = await load_chat_ro(conn, chat_id)
+    if chat is None:
+        chat = _CHATS.setdefault(chat_id, _new_chat())
+    return chat
+
+
+async def replace_teams(conn: aiosqlite.Connection, chat_id: int, teams: List[str]) -> None:
+    rows = [(chat_id, idx, t, t.casefold()) for idx, t in enumerate(teams)]
+    await conn.execute("DELETE FROM teams WHERE chat_id = ?", (chat_id,))
+    await conn.executemany(
+        "INSERT INTO teams (chat_id, idx, name, name_lc) VALUES (?, ?, ?, ?)", rows
+    )
+
+
+async def append_teams(
+    conn: aiosqlite.Connection, chat_id: int, first_idx: int, teams: List[str]
+) -> None:
+    rows = [(chat_id, idx, t, t.casefold()) for idx, t in enumerate(teams, start=first_idx)]
+    await conn.executemany(
+        "INSERT OR REPLACE INTO teams (chat_id, idx, name, name_lc) VALUES (?, ?, ?, ?)", rows
+    )
+
+
+async def save_chat(
+    conn: aiosqlite.Connection, chat_id: int, chat: Dict[str, Any], changes: Dict[str, Any]
+) -> None:
+    # Write only the parts named in `changes` (see mark_dirty). Snapshot
+    # everything before the first await so handlers can't change the chat
+    # halfway through the write.
+    write_row = "name" in changes or not chat.get("_stored")
+    teams_from = 0 if "teams" in changes else changes.get("teams_from")
+    teams = chat["teams"][teams_from:] if teams_from is not None else []
+    write_bracket = "bracket" in changes
+    br = chat.get("bracket") if write_bracket else None
+    if br:
+        br = _dumps({k: v for k, v in br.items() if k not in _TRANSIENT_BRACKET_KEYS})
+    if write_row:
+        await conn.execute(
+            "INSERT INTO chats (chat_id, name, created_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET name = excluded.name",
+            (chat_id, chat["name"], chat["created_at"]),
+        )
+    if "teams" in changes:
+        await replace_teams(conn, chat_id, teams)
+    elif teams_from is not None:
+        await append_teams(conn, chat_id, teams_from, teams)
+    if not write_bracket:
+        return
+    if br:
+        await conn.execute(
+            "INSERT OR REPLACE INTO brackets (chat_id, json) VALUES (?, ?)", (chat_id, br)
+        )
+    else:
+        await conn.execute("DELETE FROM brackets WHERE chat_id = ?", (chat_id,))
+
+
+_CHAT_FILE_RE = re.compile(r"-?\d+\.json")
+
+
+async def migrate_json_files(conn: aiosqlite.Connection) -> None:
+    # Import data.json and <chat_id>.json files written by older versions;
+    # anything else in DATA_DIR is left alone.
+    paths = {
+        os.path.abspath(os.path.join(DATA_DIR, name))
+        for name in os.listdir(DATA_DIR) if _CHAT_FILE_RE.fullmatch(name)
+    } if os.path.isdir(DATA_DIR) else set()
+    if os.path.isfile(DATA_FILE):
+        paths.add(os.path.abspath(DATA_FILE))
+    for path in sorted(paths):
+        try:
+            with open(path, "rb") as f:
+                data = _loads(f.read())
+        except Exception:
+            logger.exception("Skipping unreadable %s", path)
+            continue
+        if not isinstance(data, dict):
+            logger.warning("Skipping %s: expected a JSON object", path)
+            continue
+        stem = os.path.splitext(os.path.basename(path))[0]
+        chats = {stem: data} if _CHAT_FILE_RE.fullmatch(os.path.basename(path)) else data
+        for key, chat in chats.items():
+            try:
+                chat_id = int(key)
+            except ValueError:
+                logger.warning("Skipping chat %r in %s: not a chat id", key, path)
+                continue
+            if not isinstance(chat, dict):
+                logger.warning("Skipping chat %s in %s: expected a JSON object", key, path)
+                continue
+            async with conn.execute(
+                "SELECT 1 FROM chats WHERE chat_id = ?", (chat_id,)
+            ) as cur:
+                if await cur.fetchone() is not None:
+                    continue
+            try:
+                await save_chat(conn, chat_id, {**_new_chat(), **chat}, _ALL_CHANGES)
+                await conn.commit()
+            except Exception:
+                logger.exception("Skipping chat %s in %s", key, path)
+                await conn.rollback()
+        os.replace(path, path + ".migrated")
+
+
+# Chats are read from SQLite on first use and stay in memory. Handlers
+# mutate them in place and call mark_dirty(); _chat_writer() persists them
+# in the background.
+_CHATS: Dict[int, Dict[str, Any]] = {}
+# chat_id -> parts changed since the last write (see mark_dirty)
+_DIRTY: Dict[int, Dict[str, Any]] = {}
+_DIRTY_EVENT = asyncio.Event()
+_CLOSING = False
+# Seconds to wait before retrying chats whose write failed
+WRITE_RETRY_DELAY = 5
+
+
+def get_conn(context: ContextTypes.DEFAULT_TYPE) -> aiosqlite.Connection:
+    return context.application.bot_data["db"]
+
+
+def mark_dirty(chat_id: int, *parts: str, teams_from: Optional[int] = None) -> None:
+    # parts: "name", "teams" (all rows rewritten) and/or "bracket";
+    # teams_from: teams were appended starting at that index
+    changes = _DIRTY.setdefault(chat_id, {})
+    for part in parts:
+        changes[part] = True
+    if teams_from is not None:
+        changes["teams_from"] = min(teams_from, changes.get("teams_from", teams_from))
+    _DIRTY_EVENT.set()
+
+
+def _requeue(chat_id: int, changes: Dict[str, Any]) -> None:
+    parts = [k for k in changes if k != "teams_from"]
+    mark_dirty(chat_id, *parts, teams_from=changes.get("teams_from"))
+
+
+async def _chat_writer(conn: aiosqlite.Connection) -> None:
+    while True:
+        await _DIRTY_EVENT.wait()
+        _DIRTY_EVENT.clear()
+        dirty = dict(_DIRTY)
+        _DIRTY.clear()
+        failed = False
+        for chat_id, changes in dirty.items():
+            chat = _CHATS[chat_id]
+            try:
+                await save_chat(conn, chat_id, chat, changes)
+                await conn.commit()
+                chat["_stored"] = True
+            except Exception:
+                logger.exception("Failed to save chat %s; will retry", chat_id)
+                failed = True
+                try:
+                    await conn.rollback()
+                except Exception:
+                    logger.exception("Rollback failed")
+                # Put it back so the next wake-up retries it
+                _requeue(chat_id, changes)
+        if failed:
+            if _CLOSING:
+                logger.error("Giving up on unsaved chats at shutdown: %s", sorted(_DIRTY))
+                return
+            await asyncio.sleep(WRITE_RETRY_DELAY)
+        if _CLOSING and not _DIRTY_EVENT.is_set():
+            return
+
+
+async def _post_init(app: Application) -> None:
+    conn = app.bot_data["db"] = await open_db()
+    await migrate_json_files(conn)
+    app.bot_data["chat_writer"] = asyncio.create_task(_chat_writer(conn))
+
+
+async def _post_shutdown(app: Application) -> None:
+    # Wake the writer one last time so pending changes hit the disk.
+    global _CLOSING
+    _CLOSING = True
+    _DIRTY_EVENT.set()
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-
-def save_db(db: Dict[str, Any]) -> None:
-    # Ensure parent folder exists
-    os.makedirs(os.path.dirname(DATA_FILE) or ".", exist_ok=True)
-    tmp = DATA_FILE + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, DATA_FILE)
-
-
-def get_chat(db: Dict[str, Any], chat_id: int) -> Dict[str, Any]:
-    key = str(chat_id)
-    if key not in db:
-        db[key] = {
-            "name": None,
-            "teams": [],
-            "bracket": None,  # list of rounds; each round is list of pair tuples
-            "created_at": datetime.utcnow().isoformat(),
-        }
-    return db[key]
+        await app.bot_data.pop("chat_writer")
+    finally:
+        await app.bot_data.pop("db").close()
 
 # -----------------------------
 # Bracket logic
@@ -81,6 +345,9 @@ def get_chat(db: Dict[str, Any], chat_id: int) -> Dict[str, Any]:
 Pair = Tuple[str, str]
 Round = List[Pair]
 
+# Stay well below Telegram's 4096-character message limit
+MAX_MESSAGE_LEN = 3500
+
 
 def next_power_of_two(n: int) -> int:
     if n < 1:
@@ -97,6 +364,22 @@ def build_first_round(teams: List[str]) -> Round:
     return pairs
 
 
+@functools.lru_cache(maxsize=16)
+def _placeholder_rounds(n_first_matches: int) -> Tuple[Tuple[Pair, ...], ...]:
+    # Rounds 2..N only depend on the bracket size, never on team names
+    rounds: List[Tuple[Pair, ...]] = []
+    matches_in_round = n_first_matches
+    while matches_in_round > 1:
+        prev_round_no = len(rounds) + 1
+        next_round = tuple(
+            (f"Winner of R{prev_round_no}M{i + 1}", f"Winner of R{prev_round_no}M{i + 2}")
+            for i in range(0, matches_in_round, 2)
+        )
+        rounds.append(next_round)
+        matches_in_round = len(next_round)
+    return tuple(rounds)
+
+
 def build_full_bracket(seed_teams: List[str]) -> List[Round]:
     # Ensure power-of-two by adding BYEs
     n = len(seed_teams)
@@ -105,45 +388,105 @@ def build_full_bracket(seed_teams: List[str]) -> List[Round]:
     teams = seed_teams[:] + ["BYE"] * byes
     # Shuffle already performed before calling typically, but keep order
     r1 = build_first_round(teams)
-    rounds: List[Round] = [r1]
+    # Copy the cached tuples into lists so every round is a Round
+    return [r1, *map(list, _placeholder_rounds(len(r1)))]
 
-    # Build placeholder rounds
-    matches_in_round = len(r1)
-    while matches_in_round > 1:
-        next_round: Round = []
-        for i in range(0, matches_in_round, 2):
-            m1 = i + 1
-            m2 = i + 2
-            left = f"Winner of R{len(rounds)}M{m1}"
-            right = f"Winner of R{len(rounds)}M{m2}"
-            next_round.append((left, right))
-        rounds.append(next_round)
-        matches_in_round = len(next_round)
-    return rounds
+
+def _round_lines(pairs: Round, round_no: int) -> List[str]:
+    # Single source of the round/match line format for every rendered view
+    lines = [f"*Round {round_no}*:"]
+    lines.extend(f"M{idx}. {a} — {b}" for idx, (a, b) in enumerate(pairs, start=1))
+    return lines
 
 
 def render_pairs_text(pairs: Round, round_no: int) -> str:
-    lines = [f"*Round {round_no}*:"]
-    for idx, (a, b) in enumerate(pairs, start=1):
-        vs = f"{a} — {b}"
-        lines.append(f"M{idx}. {vs}")
-    return "\n".join(lines)
+    return "\n".join(_round_lines(pairs, round_no))
 
 
 def render_bracket_tree(rounds: List[Round]) -> str:
-    # Text-only bracket representation
-    parts: List[str] = []
+    # Text-only bracket representation, built in one list and joined once
+    lines: List[str] = []
     for i, rnd in enumerate(rounds, start=1):
-        parts.append(render_pairs_text(rnd, i))
+        lines.extend(_round_lines(rnd, i))
         if i != len(rounds):
-            parts.append("")
-    return "\n".join(parts)
+            lines.append("")
+    return "\n".join(lines)
+
+
+def pack_lines(text: str, limit: int) -> List[str]:
+    """Greedily pack whole lines into chunks of at most `limit` characters.
+
+    No chunk cuts a line (and its Markdown) in half. Blank lines at chunk
+    edges are trimmed and blank chunks, which Telegram rejects, dropped:
+
+    >>> pack_lines("a\\n\\n" + "x" * 4, 4)
+    ['a', 'xxxx']
+    """
+    chunks: List[str] = []
+    buf: List[str] = []
+    size = 0
+
+    def flush() -> None:
+        # Blank lines at a chunk edge would only show up as empty space
+        chunk = "\n".join(buf).strip("\n")
+        if chunk.strip():
+            chunks.append(chunk)
+
+    for line in text.split("\n"):
+        # A single line longer than the limit still has to be sliced
+        for piece in (line[i:i + limit] for i in range(0, len(line) or 1, limit)):
+            extra = len(piece) + 1 if buf else len(piece)
+            if buf and size + extra > limit:
+                flush()
+                buf, size, extra = [], 0, len(piece)
+            buf.append(piece)
+            size += extra
+    if buf:
+        flush()
+    return chunks
+
+
+def render_csv(rounds: List[Round]) -> bytes:
+    # Create CSV with Round, Match, Team A, Team B, encoding straight to bytes
+    raw = io.BytesIO()
+    buf = io.TextIOWrapper(raw, encoding="utf-8", newline="", write_through=True)
+    writer = csv.writer(buf)
+    writer.writerow(["Round", "Match", "Team A", "Team B"])
+    for r_idx, rnd in enumerate(rounds, start=1):
+        writer.writerows((r_idx, m_idx, a, b) for m_idx, (a, b) in enumerate(rnd, start=1))
+    buf.detach()  # keep raw open when the wrapper is collected
+    return raw.getvalue()
+
+
+def rendered_r1(br: Dict[str, Any]) -> str:
+    text = br.get("rendered_r1")
+    if text is None:
+        text = br["rendered_r1"] = render_pairs_text(br["rounds"][0], 1)
+    return text
+
+
+def rendered_full(br: Dict[str, Any]) -> str:
+    text = br.get("rendered_full")
+    if text is None:
+        text = br["rendered_full"] = render_bracket_tree(br["rounds"])
+    return text
+
+
+def rendered_csv(br: Dict[str, Any]) -> bytes:
+    data = br.get("csv")
+    if data is None:
+        data = br["csv"] = render_csv(br["rounds"])
+    return data
 
 
 # -----------------------------
 # Bot command handlers
 # -----------------------------
 
+# /new without a name; the date is filled in by a single strftime call
+DEFAULT_NAME_FORMAT = "Tournament %Y-%m-%d"
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
         "Ассалом! Я помогу собрать сетку на выбывание.\n\n"
@@ -165,55 +508,60 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def cmd_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = load_db()
-    chat = get_chat(db, update.effective_chat.id)
-    name = " ".join(context.args).strip() or f"Tournament {datetime.utcnow():%Y-%m-%d}"
+    chat = await load_chat(get_conn(context), update.effective_chat.id)
+    name = " ".join(context.args).strip() or time.strftime(DEFAULT_NAME_FORMAT, time.gmtime())
     chat["name"] = name
     chat["teams"] = []
+    chat["_teams_lc"] = set()
     chat["bracket"] = None
-    save_db(db)
+    mark_dirty(update.effective_chat.id, "name", "teams", "bracket")
     await update.message.reply_text(f"Создан турнир: *{name}*. Добавьте команды через /add", parse_mode=ParseMode.MARKDOWN)
 
 
+_TEAM_SEP = re.compile(r"[;,\n]")
+
+
 def _normalize_teams(raw: str) -> List[str]:
-    # split by semicolon, comma or newline
-    parts = [p.strip() for p in raw.replace("\n", ";").replace(",", ";").split(";")]
-    teams = [p for p in parts if p]
-    # dedupe while keeping order
-    seen = set()
-    uniq: List[str] = []
-    for t in teams:
-        if t.lower() not in seen:
-            seen.add(t.lower())
-            uniq.append(t)
-    return uniq
+    # split by semicolon, comma or newline; dedupe keeping the first spelling
+    uniq: Dict[str, str] = {}
+    for p in _TEAM_SEP.split(raw):
+        p = p.strip()
+        if p:
+            uniq.setdefault(p.casefold(), p)
+    return list(uniq.values())
 
 
 async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = load_db()
-    chat = get_chat(db, update.effective_chat.id)
-    if not context.args and not update.message.text.partition(" ")[2].strip():
+    # Split on any whitespace so teams may start on the line after /add
+    parts = update.message.text.split(None, 1)
+    raw = parts[1].strip() if len(parts) > 1 else ""
+    if not raw:
         await update.message.reply_text("Укажите команды после /add через ';' или с новой строки.")
         return
-    raw = update.message.text.partition(" ")[2]
     new = _normalize_teams(raw)
     if not new:
         await update.message.reply_text("Не удалось распознать названия.")
         return
+    # Only create the chat once there is something to store in it
+    chat = await load_chat(get_conn(context), update.effective_chat.id)
     before = len(chat["teams"])
     # Append while avoiding dups (case-insensitive)
-    existing_low = {t.lower() for t in chat["teams"]}
+    existing_lc = chat["_teams_lc"]
     for t in new:
-        if t.lower() not in existing_low:
+        t_lc = t.casefold()
+        if t_lc not in existing_lc:
+            existing_lc.add(t_lc)
             chat["teams"].append(t)
-    save_db(db)
+    mark_dirty(update.effective_chat.id, teams_from=before)
     added = len(chat["teams"]) - before
     await update.message.reply_text(f"Добавлено команд: *{added}*. Всего: *{len(chat['teams'])}*.", parse_mode=ParseMode.MARKDOWN)
 
 
 async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = load_db()
-    chat = get_chat(db, update.effective_chat.id)
+    chat = await load_chat_ro(get_conn(context), update.effective_chat.id)
+    if chat is None:
+        await update.message.reply_text("Турнир ещё не создан. Используйте /new.")
+        return
     teams = chat["teams"]
     if not teams:
         await update.message.reply_text("Список пуст. Добавьте команды через /add.")
@@ -223,85 +571,103 @@ async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def cmd_draw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = load_db()
-    chat = get_chat(db, update.effective_chat.id)
-    teams = chat["teams"]
+    chat = await load_chat_ro(get_conn(context), update.effective_chat.id)
+    teams = chat["teams"] if chat else []
     if len(teams) < 2:
         await update.message.reply_text("Нужно минимум 2 команды.")
         return
-    seed = random.randint(100000, 999999)
-    random.Random(seed).shuffle(teams)
+    # 64-bit seed from the OS RNG; shown as hex so a draw can be replayed
+    seed = f"{secrets.randbits(64):016x}"
+    random.Random(int(seed, 16)).shuffle(teams)
     rounds = build_full_bracket(teams)
     chat["bracket"] = {
         "seed": seed,
         "rounds": rounds,
+        "rendered_full": render_bracket_tree(rounds),
+        "rendered_r1": render_pairs_text(rounds[0], 1),
+        "csv": render_csv(rounds),
     }
-    save_db(db)
-    r1_text = render_pairs_text(rounds[0], 1)
+    # The shuffle reorders every team row
+    mark_dirty(update.effective_chat.id, "teams", "bracket")
+    r1_text = chat["bracket"]["rendered_r1"]
     await update.message.reply_text(
         f"Сетка создана. Seed: `{seed}`\n\n{r1_text}", parse_mode=ParseMode.MARKDOWN
     )
 
 
 async def cmd_pairs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = load_db()
-    chat = get_chat(db, update.effective_chat.id)
+    chat = await load_chat_ro(get_conn(context), update.effective_chat.id)
+    if chat is None:
+        await update.message.reply_text("Турнир ещё не создан. Используйте /new.")
+        return
     br = chat.get("bracket")
     if not br:
         await update.message.reply_text("Сетка ещё не создана. Используйте /draw.")
         return
-    text = render_pairs_text(br["rounds"][0], 1)
+    text = rendered_r1(br)
     await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
 
 async def cmd_bracket(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = load_db()
-    chat = get_chat(db, update.effective_chat.id)
+    chat = await load_chat_ro(get_conn(context), update.effective_chat.id)
+    if chat is None:
+        await update.message.reply_text("Турнир ещё не создан. Используйте /new.")
+        return
     br = chat.get("bracket")
     if not br:
         await update.message.reply_text("Сетка ещё не создана. Используйте /draw.")
         return
-    text = f"*{chat['name'] or 'Турнир'}*\n\n" + render_bracket_tree(br["rounds"])
-    # Telegram has message length limits; send in chunks if needed
-    MAX = 3500
-    for i in range(0, len(text), MAX):
-        await update.message.reply_text(text[i:i+MAX], parse_mode=ParseMode.MARKDOWN)
+    # Telegram has message length limits; send in chunks if needed.
+    # The name only changes via /new, which drops the bracket and its cache.
+    chunks = br.get("chunks")
+    if chunks is None:
+        text = f"*{chat['name'] or 'Турнир'}*\n\n" + rendered_full(br)
+        chunks = br["chunks"] = pack_lines(text, MAX_MESSAGE_LEN)
+    for chunk in chunks:
+        await update.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN)
 
 
 async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = load_db()
-    chat = get_chat(db, update.effective_chat.id)
+    chat = await load_chat_ro(get_conn(context), update.effective_chat.id)
+    if chat is None:
+        await update.message.reply_text("Турнир ещё не создан. Используйте /new.")
+        return
     br = chat.get("bracket")
     if not br:
         await update.message.reply_text("Сетка ещё не создана. Используйте /draw.")
         return
-    # Create CSV with Round, Match, Team A, Team B
-    buf = io.StringIO()
-    writer = csv.writer(buf)
-    writer.writerow(["Round", "Match", "Team A", "Team B"])
-    for r_idx, rnd in enumerate(br["rounds"], start=1):
-        for m_idx, (a, b) in enumerate(rnd, start=1):
-            writer.writerow([r_idx, m_idx, a, b])
-    data = buf.getvalue().encode("utf-8")
+    data = rendered_csv(br)
     filename = f"{(chat['name'] or 'tournament').replace(' ', '_')}_bracket.csv"
     await update.message.reply_document(document=data, filename=filename, read_timeout=30)
 
 
 async def cmd_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = load_db()
-    chat = get_chat(db, update.effective_chat.id)
+    chat = await load_chat(get_conn(context), update.effective_chat.id)
     chat["teams"] = []
+    chat["_teams_lc"] = set()
     chat["bracket"] = None
-    save_db(db)
+    mark_dirty(update.effective_chat.id, "teams", "bracket")
     await update.message.reply_text("Турнир очищен. Создайте новый /new и добавьте команды /add.")
 
 
+# Only plain messages carry commands; don't let Telegram send us anything else
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+
 def main() -> None:
     token = os.getenv("BOT_TOKEN")
     if not token:
         raise SystemExit("Please set BOT_TOKEN environment variable.")
 
-    app = Application.builder().token(token).build()
+    app = (
+        Application.builder()
+        .token(token)
+        # Chats are independent, so one slow reply shouldn't hold up others
+        .concurrent_updates(True)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("help", cmd_help))
@@ -314,7 +680,21 @@ def main() -> None:
     app.add_handler(CommandHandler("export", cmd_export))
     app.add_handler(CommandHandler("reset", cmd_reset))
 
-    app.run_polling()
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        # Telegram pushes updates to us; needs python-telegram-bot[webhooks]
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8080")),
+            url_path=token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{token}",
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        # Long-poll: each getUpdates is held open for up to 30s instead of
+        # returning empty every few seconds
+        app.run_polling(timeout=30, poll_interval=0, allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":